@@ -1,23 +1,52 @@
 import os
+import redis
 from dotenv import load_dotenv
 
-from flask import Flask, render_template, request, flash, redirect, session, g, jsonify
+from flask import (
+    Flask, render_template, request, flash, redirect, session, g, jsonify,
+    abort, make_response,
+)
 from flask_wtf import CSRFProtect
+from flask_session import Session
 from flask_debugtoolbar import DebugToolbarExtension
 from werkzeug.exceptions import Unauthorized
+from werkzeug.local import LocalProxy
+from sqlalchemy import delete, insert, inspect, literal, select, union_all
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload, joinedload, make_transient_to_detached
 
 from forms import (
     CSRFProtectForm, UserAddForm, LoginForm, MessageForm, UserEditForm
 )
 from models import (
-    db, connect_db, User, Message, Like,
+    db, bcrypt, cache, connect_db, User, Message, Like, Follows,
     DEFAULT_IMAGE_URL, DEFAULT_HEADER_IMAGE_URL
 )
 
 load_dotenv()
 
 CURR_USER_KEY = "curr_user"
+AUTH_TOKEN_KEY = "auth_token"
+
+# Columns of the logged-in user kept in the cache; relationships (and the
+# password hash) are left out and load from the DB only if a route needs them.
+USER_CACHE_FIELDS = (
+    "id", "username", "email", "image_url", "header_image_url", "bio",
+    "location", "followers_count", "following_count", "likes_count",
+)
+USER_CACHE_TIMEOUT = 60
+
+SEARCH_RESULTS_LIMIT = 50
+
+# Seconds the ids of users matching a search stay cached
+SEARCH_CACHE_TIMEOUT = 30
+
+# Seconds a user's homepage feed (the ids of its messages) stays cached
+FEED_CACHE_TIMEOUT = 30
+
+# Seconds browsers/proxies may cache the logged-out homepage
+ANON_HOMEPAGE_MAX_AGE = 300
 
 csrf = CSRFProtect()
 app = Flask(__name__)
@@ -28,11 +57,53 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ['DATABASE_URL'].replace("postgres://", "postgresql://"))
 app.config['SQLALCHEMY_ECHO'] = False
+# Room for more compiled statements than the default 500, so the queries
+# we run on every request don't get pushed out and compiled again.
+# Pool: DB_POOL_SIZE should be about the number of requests one worker
+# handles at once; check connections before use, and replace them before
+# Postgres (or a proxy in front of it) drops them for being idle.
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'query_cache_size': 1200,
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 20)),
+    'max_overflow': 10,
+    'pool_pre_ping': True,
+    'pool_recycle': 1800,
+}
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
-toolbar = DebugToolbarExtension(app)
+# Cost factor of password hashes; only lower this for tests
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+
+# Cache in Redis if CACHE_REDIS_URL is set, else don't cache at all: an
+# in-process SimpleCache can't be cleared from the other workers, so they'd
+# keep serving a profile or count for a minute after it changed. (Set
+# CACHE_TYPE=SimpleCache to use one anyway, e.g. with a single worker.)
+app.config['CACHE_REDIS_URL'] = os.environ.get('CACHE_REDIS_URL')
+app.config['CACHE_TYPE'] = os.environ.get(
+    'CACHE_TYPE',
+    'RedisCache' if app.config['CACHE_REDIS_URL'] else 'NullCache')
+app.config['CACHE_NO_NULL_WARNING'] = True
+# Keep going when delete_many() meets a key that isn't cached
+app.config['CACHE_IGNORE_ERRORS'] = True
+
+# Sessions are signed cookies unless SESSION_REDIS_URL is set; then they're
+# kept in Redis (which can be the same one as the cache)
+if os.environ.get('SESSION_REDIS_URL'):
+    app.config['SESSION_TYPE'] = 'redis'
+    app.config['SESSION_REDIS'] = redis.from_url(
+        os.environ['SESSION_REDIS_URL'])
+
+# The toolbar instruments every request (SQL, templates), so only attach it
+# when we're actually debugging (the tests make sure FLASK_DEBUG is off)
+if app.debug:
+    toolbar = DebugToolbarExtension(app)
 
 csrf.init_app(app)
+cache.init_app(app)
+bcrypt.init_app(app)
+
+if app.config.get('SESSION_TYPE'):
+    Session(app)
 
 connect_db(app)
 
@@ -43,32 +114,178 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global (None if not).
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    Also add a CSRF form so that every route can use it, and the ids of the
+    users they follow for follow buttons. These are only loaded/built once
+    something reads them, so routes that never look at them (or log the
+    user out first) don't pay for them. Static files need none of them.
+    """
 
-    else:
-        g.user = None
+    if request.endpoint == 'static':
+        return
 
-@app.before_request
-def add_csrf_form():
-    """Add a CSRF form so that every route can use it"""
+    # g outlives the request when an app context is already pushed (as
+    # connect_db does), so don't pick up the last request's user or form
+    g.pop('_user', None)
+    g.pop('_csrf_form', None)
+    g.pop('_following_ids', None)
+
+    g.user = LocalProxy(get_g_user)
+    g.csrf_form = LocalProxy(get_csrf_form)
+    g.following_ids = LocalProxy(get_following_ids)
+
+
+def get_g_user():
+    """Get the logged-in user for this request, loading them on first use."""
+
+    if '_user' not in g:
+        user_id = session.get(CURR_USER_KEY)
+        g._user = get_curr_user(user_id) if user_id else None
+
+    return g._user
+
+
+def get_csrf_form():
+    """Get the CSRF form for this request, building it on first use."""
+
+    if '_csrf_form' not in g:
+        g._csrf_form = CSRFProtectForm()
+
+    return g._csrf_form
+
+
+def get_following_ids():
+    """Get the set of ids of users the logged-in user follows, on first use.
+
+    For follow buttons: a page of users checks every one of them, and a
+    user from the cache has no following list loaded, so get all the ids in
+    one SELECT rather than asking about each user in turn.
+    """
+
+    if '_following_ids' not in g:
+        user = g.user._get_current_object()
+
+        if not user:
+            g._following_ids = set()
+        elif 'following' not in inspect(user).unloaded:
+            g._following_ids = {followed.id for followed in user.following}
+        else:
+            g._following_ids = set(db.session.scalars(
+                select(Follows.user_being_followed_id)
+                .where(Follows.user_following_id == user.id)))
+
+    return g._following_ids
+
+
+def get_curr_user(user_id):
+    """Get logged-in user, from the cache if we can, else from the DB.
+
+    A cached user is attached to the session without a SELECT; anything not
+    cached (relationships, password) is loaded lazily if it's used.
+    """
+
+    data = cache.get(f"user:{user_id}")
+
+    if data:
+        user = User(**data)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    # Load the collections checked on nearly every page (follow buttons,
+    # like stars) up front, so they cost one query each rather than a
+    # lazy SELECT wherever a template first touches them. Load whole rows:
+    # the user's own following/likes pages render these same objects.
+    user = db.session.get(
+        User,
+        user_id,
+        options=[
+            selectinload(User.following),
+            selectinload(User.liked_messages),
+        ],
+    )
+
+    if user:
+        cache.set(
+            f"user:{user_id}",
+            {field: getattr(user, field) for field in USER_CACHE_FIELDS},
+            timeout=USER_CACHE_TIMEOUT,
+        )
+
+    return user
 
-    g.csrf_form = CSRFProtectForm()
 
 def do_login(user):
-    """Log in user."""
+    """Log in user.
+
+    They've just given their password, so the session also gets a token
+    that spares checking it again for a little while.
+    """
 
     session[CURR_USER_KEY] = user.id
+    session[AUTH_TOKEN_KEY] = user.issue_auth_token()
 
 
 def do_logout():
     """Log out user."""
 
     if CURR_USER_KEY in session:
+        cache.delete(f"auth:{session[CURR_USER_KEY]}")
         del session[CURR_USER_KEY]
 
+    session.pop(AUTH_TOKEN_KEY, None)
+
+
+def clear_feeds(user_id):
+    """Clear the cached homepage feeds that show this user's messages.
+
+    That's the user's own feed and the feeds of everyone following them.
+    """
+
+    follower_ids = db.session.scalars(
+        select(Follows.user_following_id)
+        .where(Follows.user_being_followed_id == user_id))
+
+    cache.delete_many(*[f"feed:{id}" for id in [user_id, *follower_ids]])
+
+
+def get_liked_ids():
+    """Get the set of ids of messages the logged-in user has liked.
+
+    For like buttons: checking an id against a set is cheaper than checking
+    each message against the user's list of liked messages.
+    """
+
+    return {msg.id for msg in g.user.liked_messages}
+
+
+def get_user_or_404(user_id):
+    """Get user by id, or raise a 404 if there's no such user.
+
+    The logged-in user is already loaded, so their own pages reuse g.user.
+    """
+
+    if g.user and g.user.id == user_id:
+        return g.user._get_current_object()
+
+    user = db.session.get(User, user_id)
+
+    if not user:
+        abort(404)
+
+    return user
+
+
+def get_message_or_404(message_id):
+    """Get message by id, or raise a 404 if there's no such message."""
+
+    msg = db.session.get(Message, message_id)
+
+    if not msg:
+        abort(404)
+
+    return msg
+
 
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
@@ -161,7 +378,22 @@ def list_users():
     if not search:
         users = User.query.all()
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        search_key = f"user-search:{search}"
+        user_ids = cache.get(search_key)
+
+        if user_ids is None:
+            users = (User.query
+                     .filter(User.username.ilike(f"%{search}%"))
+                     .order_by(User.username)
+                     .limit(SEARCH_RESULTS_LIMIT)
+                     .all())
+            cache.set(search_key, [user.id for user in users],
+                      timeout=SEARCH_CACHE_TIMEOUT)
+        else:
+            users = (User.query
+                     .filter(User.id.in_(user_ids))
+                     .order_by(User.username)
+                     .all())
 
     return render_template('users/index.html', users=users)
 
@@ -174,9 +406,10 @@ def show_user(user_id):
         raise Unauthorized()
 
     form = g.csrf_form
-    user = User.query.get_or_404(user_id)
+    user = get_user_or_404(user_id)
 
-    return render_template('users/show.html', user=user, form=form)
+    return render_template(
+        'users/show.html', user=user, form=form, liked_ids=get_liked_ids())
 
 
 @app.get('/users/<int:user_id>/following')
@@ -186,7 +419,7 @@ def show_following(user_id):
     if not g.user:
         raise Unauthorized()
 
-    user = User.query.get_or_404(user_id)
+    user = get_user_or_404(user_id)
     return render_template('users/following.html', user=user)
 
 
@@ -197,7 +430,7 @@ def show_followers(user_id):
     if not g.user:
         raise Unauthorized()
 
-    user = User.query.get_or_404(user_id)
+    user = get_user_or_404(user_id)
     return render_template('users/followers.html', user=user)
 
 
@@ -211,9 +444,25 @@ def start_following(follow_id):
     if not g.user:
         raise Unauthorized()
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    followed_user = get_user_or_404(follow_id)
+
+    # Insert the follow directly, rather than appending to g.user.following,
+    # which would load every user they already follow
+    try:
+        db.session.execute(insert(Follows).values(
+            user_being_followed_id=followed_user.id,
+            user_following_id=g.user.id,
+        ))
+    except IntegrityError:
+        # Already following them
+        db.session.rollback()
+        return redirect(f"/users/{g.user.id}/following")
+
+    g.user.following_count = User.following_count + 1
+    followed_user.followers_count = User.followers_count + 1
     db.session.commit()
+    cache.delete_many(
+        f"user:{g.user.id}", f"user:{followed_user.id}", f"feed:{g.user.id}")
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -228,9 +477,21 @@ def stop_following(follow_id):
     if not g.user:
         raise Unauthorized()
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    followed_user = get_user_or_404(follow_id)
+
+    result = db.session.execute(
+        delete(Follows)
+        .where(Follows.user_being_followed_id == followed_user.id)
+        .where(Follows.user_following_id == g.user.id))
+
+    # Only change the counts if they really were following them
+    if result.rowcount:
+        g.user.following_count = User.following_count - 1
+        followed_user.followers_count = User.followers_count - 1
+
     db.session.commit()
+    cache.delete_many(
+        f"user:{g.user.id}", f"user:{followed_user.id}", f"feed:{g.user.id}")
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -251,7 +512,8 @@ def profile():
     if form.validate_on_submit():
         user = User.authenticate(
             form.username.data,
-            form.password.data
+            form.password.data,
+            auth_token=session.get(AUTH_TOKEN_KEY),
         )
 
         if user:
@@ -265,6 +527,7 @@ def profile():
             user.bio = form.bio.data
 
             db.session.commit()
+            cache.delete(f"user:{user.id}")
 
             return redirect(f"/users/{user.id}")
         else:
@@ -285,8 +548,20 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # The follows rows go with the user (ON DELETE CASCADE), so fix up the
+    # counts of everyone on the other end of them
+    for follower in g.user.followers:
+        follower.following_count = User.following_count - 1
+    for followed_user in g.user.following:
+        followed_user.followers_count = User.followers_count - 1
+    cache_keys = [
+        f"user:{user.id}"
+        for user in [g.user, *g.user.followers, *g.user.following]
+    ]
+
+    db.session.delete(g.user._get_current_object())
     db.session.commit()
+    cache.delete_many(*cache_keys)
 
     return redirect("/signup")
 
@@ -310,6 +585,7 @@ def add_message():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
         db.session.commit()
+        clear_feeds(g.user.id)
 
         return redirect(f"/users/{g.user.id}")
 
@@ -324,9 +600,10 @@ def show_message(message_id):
         raise Unauthorized()
 
     form = g.csrf_form
-    msg = Message.query.get_or_404(message_id)
+    msg = get_message_or_404(message_id)
 
-    return render_template('messages/show.html', msg=msg, form=form)
+    return render_template(
+        'messages/show.html', msg=msg, form=form, liked_ids=get_liked_ids())
 
 
 @app.post('/messages/<int:message_id>/delete')
@@ -340,9 +617,17 @@ def delete_message(message_id):
     if not g.user:
         raise Unauthorized()
 
-    msg = Message.query.get_or_404(message_id)
+    msg = get_message_or_404(message_id)
+
+    author_id = msg.user_id
+    liked_by_ids = [user.id for user in msg.liked_by_users]
+    for user in msg.liked_by_users:
+        user.likes_count = User.likes_count - 1
+
     db.session.delete(msg)
     db.session.commit()
+    cache.delete_many(*[f"user:{id}" for id in liked_by_ids])
+    clear_feeds(author_id)
 
     return redirect(f"/users/{g.user.id}")
 
@@ -382,9 +667,10 @@ def show_user_likes(user_id):
         raise Unauthorized()
 
     form = g.csrf_form
-    user = User.query.get_or_404(user_id)
+    user = get_user_or_404(user_id)
 
-    return render_template("users/likes.html", user=user, form=form)
+    return render_template(
+        "users/likes.html", user=user, form=form, liked_ids=get_liked_ids())
 
 ##############################################################################
 # Homepage and error pages
@@ -401,17 +687,50 @@ def homepage():
     form = g.csrf_form
 
     if g.user:
-        following_ids = [f.id for f in g.user.following] + [g.user.id]
+        feed_key = f"feed:{g.user.id}"
+        message_ids = cache.get(feed_key)
+
+        if message_ids is None:
+            # Ids of the users we follow, plus our own, as one subquery: the
+            # DB can semi-join on it and no id list ever comes back to Python
+            feed_user_ids = union_all(
+                select(Follows.user_being_followed_id)
+                .where(Follows.user_following_id == g.user.id),
+                select(literal(g.user.id)))
+
+            message_ids = db.session.scalars(
+                select(Message.id)
+                .where(Message.user_id.in_(feed_user_ids))
+                .order_by(Message.timestamp.desc())
+                .limit(100)
+            ).all()
+            cache.set(feed_key, message_ids, timeout=FEED_CACHE_TIMEOUT)
 
         messages = (
             Message
             .query
-            .filter(Message.user_id.in_(following_ids))
-            .order_by(Message.timestamp.desc())
-            .limit(100)
+            .filter(Message.id.in_(message_ids))
+            .options(joinedload(Message.user).load_only(
+                User.id, User.username, User.image_url))
             .all())
 
-        return render_template('home.html', messages=messages, form=form)
+        # Put them back in the (newest first) order the ids were cached in
+        position = {id: i for i, id in enumerate(message_ids)}
+        messages.sort(key=lambda msg: position[msg.id])
+
+        return render_template(
+            'home.html',
+            messages=messages,
+            form=form,
+            liked_ids=get_liked_ids())
+
+    elif request.method == 'GET' and '_flashes' not in session:
+        # Same page for every anonymous visitor, so let browsers and proxies
+        # keep it (unless there's a flash message on it meant for just us)
+        resp = make_response(render_template('home-anon.html'))
+        resp.cache_control.public = True
+        resp.cache_control.max_age = ANON_HOMEPAGE_MAX_AGE
+        return resp
 
     else:
         return render_template('home-anon.html')
@@ -426,7 +745,11 @@ def homepage():
 
 @app.after_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers on every request, unless the route has marked
+    its response as public."""
+
+    if response.cache_control.public:
+        return response
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
     response.cache_control.no_store = True
@@ -441,16 +764,37 @@ def api_toggle_like(message_id):
         {favorited: True or False }
     """
 
-    user = g.user
-    liked_msg = Message.query.get_or_404(message_id)
+    if not g.user:
+        raise Unauthorized()
 
-    if liked_msg not in user.liked_messages:
-        user.liked_messages.append(liked_msg)
+    user = g.user
+    liked_msg = get_message_or_404(message_id)
+
+    # Toggle with a DELETE, then an INSERT if there was nothing to delete,
+    # so we never load the user's liked messages to check for this one
+    unliked = db.session.execute(
+        delete(Like)
+        .where(Like.liked_by_user_id == user.id)
+        .where(Like.liked_message_id == liked_msg.id)
+    ).rowcount
+
+    if not unliked:
+        liked = db.session.execute(
+            pg_insert(Like)
+            .values(liked_by_user_id=user.id, liked_message_id=liked_msg.id)
+            .on_conflict_do_nothing()
+            .returning(Like.liked_message_id)
+        ).first()
+
+        if liked:
+            user.likes_count = User.likes_count + 1
         db.session.commit()
+        cache.delete(f"user:{user.id}")
         return jsonify(favorited=True) # {favorited: True}
     else:
-        user.liked_messages.remove(liked_msg)
+        user.likes_count = User.likes_count - 1
         db.session.commit()
+        cache.delete(f"user:{user.id}")
         return jsonify(favorited=False)
 
 
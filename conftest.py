@@ -0,0 +1,151 @@
+"""Shared setup for the test suite."""
+
+# run the tests like:
+#
+#    python -m pytest
+#
+# or, to spread them over every CPU,
+#
+#    python -m pytest -n auto
+#
+# (each worker works out its database from DATABASE_URL, so that has to be
+# set in the environment or in .env)
+
+import os
+
+import pytest
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+# os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+
+def use_worker_database(worker):
+    """Point DATABASE_URL at a database of this pytest-xdist worker's own.
+
+    Workers each drop and create the tables, so they can't share one
+    database; worker gw0 of warbler_test gets warbler_test_gw0, which is
+    created the first time it's needed.
+    """
+
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        raise pytest.UsageError(
+            "pytest -n needs DATABASE_URL, in the environment or in .env, "
+            "to name each worker's database after")
+
+    url = make_url(database_url.replace("postgres://", "postgresql://"))
+    worker_url = url.set(database=f"{url.database}_{worker}")
+
+    engine = create_engine(
+        url.set(database="postgres"), isolation_level="AUTOCOMMIT")
+    with engine.connect() as conn:
+        exists = conn.execute(
+            text("SELECT 1 FROM pg_database WHERE datname = :name"),
+            {"name": worker_url.database},
+        ).scalar()
+        if not exists:
+            conn.execute(text(f'CREATE DATABASE "{worker_url.database}"'))
+    engine.dispose()
+
+    os.environ['DATABASE_URL'] = worker_url.render_as_string(hide_password=False)
+
+
+# Under `pytest -n auto`, give each worker its own database. app.py loads
+# .env too, but only once it's imported, which is too late for this
+
+load_dotenv()
+
+if os.environ.get('PYTEST_XDIST_WORKER'):
+    use_worker_database(os.environ['PYTEST_XDIST_WORKER'])
+
+# Don't cache the logged-in user between requests; tests delete and re-create
+# users directly in the DB, which the cache would never hear about. Tests of
+# the caching itself ask for a real one with the simple_cache fixture
+
+os.environ['CACHE_TYPE'] = "NullCache"
+
+# Hash test passwords with the lowest bcrypt cost; the default is ~250x the
+# work, which adds up over every user the tests sign up
+
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
+
+# Never run the tests in debug mode: app.py attaches the debug toolbar when
+# it's imported with debugging on, and the toolbar records every query and
+# template of every request
+
+os.environ['FLASK_DEBUG'] = "0"
+
+# Now we can import app (which also connects it to the database)
+
+from app import app
+from models import db, cache
+
+app.config.update(
+    TESTING=True,
+    DEBUG_TB_ENABLED=False,
+    DEBUG_TB_INTERCEPT_REDIRECTS=False,
+)
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+@pytest.fixture(scope="session", autouse=True)
+def _schema():
+    """Create the tables once for the whole test run.
+
+    Each test deletes the data it needs gone and creates fresh test data,
+    so the schema itself only has to be built once.
+    """
+
+    db.drop_all()
+    db.create_all()
+    yield
+    db.session.remove()
+    db.drop_all()
+
+
+@pytest.fixture
+def simple_cache():
+    """Give the app a real (in-process) cache for one test.
+
+    For unittest classes, use @pytest.mark.usefixtures("simple_cache").
+    """
+
+    cache.init_app(app, config={'CACHE_TYPE': "SimpleCache"})
+    yield cache
+    cache.clear()
+    cache.init_app(app)
+
+
+@pytest.fixture(autouse=True)
+def _transaction():
+    """Run each test in a transaction that is rolled back when it ends.
+
+    The session joins the transaction on one connection and turns each of
+    the app's commits and rollbacks into a SAVEPOINT instead, so nothing a
+    test writes outlives it and setUp never has to clear the tables.
+    """
+
+    connection = db.engine.connect()
+    trans = connection.begin()
+    app_session = db.session
+
+    db.session = scoped_session(sessionmaker(
+        bind=connection, join_transaction_mode="create_savepoint"))
+
+    yield
+
+    db.session.remove()
+    db.session = app_session
+    trans.rollback()
+    connection.close()
@@ -1,16 +1,26 @@
 """SQLAlchemy models for Warbler."""
 
+import hmac
+import secrets
 from datetime import datetime
 
 from flask_bcrypt import Bcrypt
+from flask_caching import Cache
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event, exists, inspect, text
 
 bcrypt = Bcrypt()
+cache = Cache()
 db = SQLAlchemy()
 
 DEFAULT_IMAGE_URL = "/static/images/default-pic.png"
 DEFAULT_HEADER_IMAGE_URL = "/static/images/warbler-hero.jpg"
 
+# Seconds a successful password check is remembered for the session that
+# made it, so checking again soon after skips the (deliberately slow) bcrypt
+# hash
+AUTH_CACHE_TIMEOUT = 60
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -75,6 +85,28 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Counts of the relationships below, kept up to date by the routes that
+    # change them, so profile pages don't have to load whole collections
+    # just to show how many there are.
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
     messages = db.relationship('Message', backref="user")
 
     followers = db.relationship(
@@ -112,7 +144,7 @@ class User(db.Model):
         return user
 
     @classmethod
-    def authenticate(cls, username, password):
+    def authenticate(cls, username, password, auth_token=None):
         """Find user with `username` and `password`.
 
         This is a class method (call it on the class, not an individual user.)
@@ -121,30 +153,90 @@ class User(db.Model):
 
         If this can't find matching user (or if password is wrong), returns
         False.
+
+        `auth_token` is a token from issue_auth_token, which the caller
+        keeps in the session: while it's still this user's current one,
+        the password isn't checked again. Nothing derived from the password
+        itself is ever cached.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
+            if auth_token and user.has_auth_token(auth_token):
+                return user
+
             is_auth = bcrypt.check_password_hash(user.password, password)
             if is_auth:
                 return user
 
         return False
 
+    def issue_auth_token(self):
+        """Make a random token standing for a password check just passed.
+
+        It's cached for AUTH_CACHE_TIMEOUT seconds, replacing any earlier
+        one, so checks elsewhere fall back to bcrypt. Returns the token.
+        """
+
+        token = secrets.token_urlsafe()
+        cache.set(f"auth:{self.id}", token, timeout=AUTH_CACHE_TIMEOUT)
+
+        return token
+
+    def has_auth_token(self, token):
+        """Is `token` this user's current token from issue_auth_token?"""
+
+        cached = cache.get(f"auth:{self.id}")
+
+        return cached is not None and hmac.compare_digest(cached, token)
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.is_following(self)
 
     def is_following(self, other_user):
-        """Is this user following `other_user`?"""
+        """Is this user following `other_user`?
+
+        Uses `following` if it's already loaded; otherwise asks the DB about
+        just this one follow, rather than loading everyone this user follows.
+        """
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        if "following" not in inspect(self).unloaded:
+            return other_user in self.following
+
+        return db.session.query(
+            exists()
+            .where(Follows.user_following_id == self.id)
+            .where(Follows.user_being_followed_id == other_user.id)
+        ).scalar()
+
+
+def has_pg_trgm(ddl, target, bind, **kw):
+    """Is this a Postgres database that can install the `pg_trgm` extension?"""
+
+    return bind.dialect.name == "postgresql" and bool(bind.execute(text(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    )).scalar())
+
+
+# A trigram index lets `ILIKE '%search%'` on usernames use an index rather
+# than scanning the whole users table
+event.listen(
+    User.__table__,
+    "after_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(
+        callable_=has_pg_trgm),
+)
+event.listen(
+    User.__table__,
+    "after_create",
+    DDL(
+        "CREATE INDEX users_username_trgm_idx "
+        "ON users USING gin (username gin_trgm_ops)"
+    ).execute_if(callable_=has_pg_trgm),
+)
 
 
 class Message(db.Model):
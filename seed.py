@@ -1,6 +1,8 @@
 """Seed database with sample data from CSV Files."""
 
 from csv import DictReader
+from sqlalchemy import text
+
 from app import db
 from models import User, Message, Follows, Like
 
@@ -16,4 +18,15 @@ with open('generator/messages.csv') as messages:
 with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
+# The bulk inserts skip the routes that keep these counts, so fill them in
+db.session.execute(text("""
+    UPDATE users SET
+        followers_count = (SELECT count(*) FROM follows
+                           WHERE user_being_followed_id = users.id),
+        following_count = (SELECT count(*) FROM follows
+                           WHERE user_following_id = users.id),
+        likes_count = (SELECT count(*) FROM likes
+                       WHERE liked_by_user_id = users.id)
+"""))
+
 db.session.commit()
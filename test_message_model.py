@@ -1,36 +1,19 @@
 """Message model tests."""
 
-import os
 from unittest import TestCase
-from sqlalchemy import exc
 
-from models import db, User, Message, Follows, connect_db
-
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-# os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
-
-# Now we can import app
+from models import db, User, Message
 
+from testing_helpers import make_user
 from app import app
 
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-connect_db(app)
 
 class MessageModelTestCase(TestCase):
     """Tests for Message Model"""
     def setUp(self):
-        db.drop_all()
-        db.create_all()
-
-        u1 = User.signup("u1", "u1@email.com", "password", None)
-        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u1 = make_user("u1")
+        u2 = make_user("u2")
+        db.session.add_all([u1, u2])
         m1 = Message(text="text")
 
         u1.messages.append(m1)
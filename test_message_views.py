@@ -2,53 +2,27 @@
 
 # run these tests like:
 #
-#    FLASK_DEBUG=False python -m unittest test_message_views.py
+#    python -m pytest test_message_views.py
 
 
-import os
 from unittest import TestCase
 
-from models import db, Message, User, connect_db
+import pytest
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-# os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
-
-# Now we can import app
+from models import db, cache, Message, User
 
+from testing_helpers import count_queries, make_user
 from app import app, CURR_USER_KEY
 
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-connect_db(app)
-
-db.drop_all()
-db.create_all()
-
-# Don't have WTForms use CSRF at all, since it's a pain to test
-
-app.config['WTF_CSRF_ENABLED'] = False
-
 
 class MessageBaseViewTestCase(TestCase):
     def setUp(self):
-        User.query.delete()
+        u1 = make_user("u1")
+        u2 = make_user("u2")
+        db.session.add_all([u1, u2])
+        m1 = Message(text="m1-text")
 
-        u1 = User.signup("u1", "u1@email.com", "password", None)
-        u2 = User.signup("u2", "u2@email.com", "password", None)
-        db.session.flush()
-
-        m1 = Message(text="m1-text", user_id=u1.id)
-
-        db.session.add(u2)
-        db.session.add_all([m1])
+        u1.messages.append(m1)
         db.session.commit()
 
         self.u1_id = u1.id
@@ -71,12 +45,18 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
 
             # Now, that session setting is saved, so we can have
             # the rest of ours test
-            resp = c.post("/messages/new", data={"text": "Hello"}, follow_redirects=True)
+            with count_queries() as queries:
+                resp = c.post(
+                    "/messages/new",
+                    data={"text": "Hello"},
+                    follow_redirects=True)
 
-            html = resp.get_data(as_text=True)
+            html = resp.get_data()
 
-            self.assertIn("Hello", html)
+            self.assertIn(b"Hello", html)
             self.assertEqual(resp.status_code, 200)
+            # Add, then redirect and render the user page
+            self.assertLessEqual(len(queries), 13)
 
 
     def test_add_message_logged_out(self):
@@ -84,7 +64,7 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
 
         with self.client as c:
 
-            resp = c.post("/messages/new", data={"text": "Hello"}, follow_redirects=True)
+            resp = c.post("/messages/new", data={"text": "Hello"})
 
             self.assertEqual(resp.status_code, 401)
 
@@ -96,20 +76,26 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = self.u1_id
 
-            get_msg_page_before = c.get(f"/messages/{self.m1_id}")
+            with count_queries() as queries:
+                get_msg_page_before = c.get(f"/messages/{self.m1_id}")
 
-            html = get_msg_page_before.get_data(as_text=True)
+            html = get_msg_page_before.get_data()
 
             # Test if message shows before deletion
-            self.assertIn("m1-text", html)
+            self.assertIn(b"m1-text", html)
             self.assertEqual(get_msg_page_before.status_code, 200)
+            self.assertLessEqual(len(queries), 4)
+
+            with count_queries() as queries:
+                c.post(f"/messages/{self.m1_id}/delete")
+
+            self.assertLessEqual(len(queries), 10)
 
-            c.post(f"/messages/{self.m1_id}/delete")
             get_msg_page_after = c.get(f"/messages/{self.m1_id}")
 
-            html = get_msg_page_after.get_data(as_text=True)
+            html = get_msg_page_after.get_data()
 
-            self.assertNotIn("m1-text", html)
+            self.assertNotIn(b"m1-text", html)
             self.assertEqual(get_msg_page_after.status_code, 404)
 
 
@@ -118,7 +104,7 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
 
         with self.client as c:
 
-            resp = c.post(f"/messages/{self.m1_id}/delete", follow_redirects=True)
+            resp = c.post(f"/messages/{self.m1_id}/delete")
 
             self.assertEqual(resp.status_code, 401)
 
@@ -131,8 +117,114 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = self.u2_id
 
-            resp = c.get(f"/messages/{self.m1_id}", follow_redirects=True)
+            resp = c.get(f"/messages/{self.m1_id}")
+
+            html = resp.get_data()
+
+            self.assertNotIn(b"DELETE BUTTON FOR TESTING PURPOSES", html)
+
+
+    def test_toggle_like_logged_in(self):
+        """Test that liking a message likes it, and liking it again unlikes it"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.post(f"/api/messages/{self.m1_id}/like")
+
+            self.assertEqual(resp.json, {"favorited": True})
+            self.assertEqual(db.session.get(User, self.u2_id).likes_count, 1)
+
+            resp = c.post(f"/api/messages/{self.m1_id}/like")
+
+            self.assertEqual(resp.json, {"favorited": False})
+            self.assertEqual(db.session.get(User, self.u2_id).likes_count, 0)
+
+
+    def test_toggle_like_logged_out(self):
+        """Test that a logged out user is prohibited from liking a message"""
+
+        with self.client as c:
+
+            resp = c.post(f"/api/messages/{self.m1_id}/like")
+
+            self.assertEqual(resp.status_code, 401)
+
+
+@pytest.mark.usefixtures("simple_cache")
+class MessageCacheViewTestCase(MessageBaseViewTestCase):
+    """Tests that message, like and follow routes clear the cached users/feeds"""
+
+    def login(self, user_id):
+        """Log the client in as this user, and load them into the cache."""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        self.client.get("/")
+
+    def cached_likes_count(self, user_id):
+        return cache.get(f"user:{user_id}")["likes_count"]
+
+    def test_like_clears_cached_user(self):
+        """Test if the next request sees the like count a like changed"""
+
+        self.login(self.u2_id)
+
+        self.client.post(f"/api/messages/{self.m1_id}/like")
+
+        self.assertIsNone(cache.get(f"user:{self.u2_id}"))
+        self.login(self.u2_id)
+        self.assertEqual(self.cached_likes_count(self.u2_id), 1)
+
+    def test_delete_message_clears_cached_likers(self):
+        """Test if deleting a message clears the users who liked it"""
+
+        self.login(self.u2_id)
+        self.client.post(f"/api/messages/{self.m1_id}/like")
+        self.login(self.u2_id)
+
+        self.login(self.u1_id)
+        self.client.post(f"/messages/{self.m1_id}/delete")
+
+        self.assertIsNone(cache.get(f"user:{self.u2_id}"))
+        self.login(self.u2_id)
+        self.assertEqual(self.cached_likes_count(self.u2_id), 0)
+
+    def test_follow_clears_cached_feed(self):
+        """Test if following and unfollowing change the next homepage"""
+
+        self.login(self.u2_id)
+
+        self.assertEqual(cache.get(f"feed:{self.u2_id}"), [])
+
+        self.client.post(f"/users/follow/{self.u1_id}")
+
+        self.assertIsNone(cache.get(f"feed:{self.u2_id}"))
+        self.assertIn(b"m1-text", self.client.get("/").get_data())
+
+        self.client.post(f"/users/stop-following/{self.u1_id}")
+
+        self.assertIsNone(cache.get(f"feed:{self.u2_id}"))
+        self.assertNotIn(b"m1-text", self.client.get("/").get_data())
+
+    def test_new_message_clears_followers_feeds(self):
+        """Test if a new message shows in its author's followers' feeds"""
+
+        self.login(self.u2_id)
+        self.client.post(f"/users/follow/{self.u1_id}")
+        self.client.get("/")
+
+        self.assertEqual(cache.get(f"feed:{self.u2_id}"), [self.m1_id])
+
+        self.login(self.u1_id)
+        self.client.post("/messages/new", data={"text": "New message"})
+
+        self.assertIsNone(cache.get(f"feed:{self.u1_id}"))
+        self.assertIsNone(cache.get(f"feed:{self.u2_id}"))
 
-            html = resp.get_data(as_text=True)
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u2_id
 
-            self.assertNotIn("DELETE BUTTON FOR TESTING PURPOSES", html)
+        self.assertIn(b"New message", self.client.get("/").get_data())
@@ -2,104 +2,89 @@
 
 # run these tests like:
 #
-#    python -m unittest test_user_model.py
+#    python -m pytest test_user_model.py
 
 
-import os
 from unittest import TestCase
-from sqlalchemy import exc
-
-from models import db, User, Message, Follows, connect_db
-
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
+from unittest.mock import patch
 
-# os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+import pytest
+from sqlalchemy import exc
 
-# Now we can import app
+from models import db, bcrypt, User
 
+from testing_helpers import make_user
 from app import app
 
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-connect_db(app)
-
-db.drop_all()
-db.create_all()
-
 
 class UserModelTestCase(TestCase):
     """Tests for User Model"""
     def setUp(self):
-        User.query.delete()
-
-        u1 = User.signup("u1", "u1@email.com", "password", None)
-        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u1 = make_user("u1")
+        u2 = make_user("u2")
+        db.session.add_all([u1, u2])
 
         db.session.commit()
         self.u1_id = u1.id
         self.u2_id = u2.id
 
+        # Keep the users themselves too; they stay in the session's identity
+        # map, so the tests needn't look them up again
+        self.u1 = u1
+        self.u2 = u2
+
         self.client = app.test_client()
 
     def tearDown(self):
         db.session.rollback()
 
     def test_user_model(self):
-        u1 = User.query.get(self.u1_id)
-
         # User should have no messages & no followers
-        self.assertEqual(len(u1.messages), 0)
-        self.assertEqual(len(u1.followers), 0)
+        self.assertEqual(len(self.u1.messages), 0)
+        self.assertEqual(len(self.u1.followers), 0)
 
     def test_repr(self):
         """ Test that the repr displays what it is supposed to."""
-        u1 = User.query.get(self.u1_id)
-
-        self.assertEqual(u1.__repr__(), "<User #1: u1, u1@email.com>")
+        self.assertEqual(
+            self.u1.__repr__(), f"<User #{self.u1_id}: u1, u1@email.com>")
 
     def test_user_following(self):
         """ Test is user following functionality works properly"""
-        u1 = User.query.get(self.u1_id)
-        u2 = User.query.get(self.u2_id)
-
-        u1.following.append(u2)
+        self.u1.following.append(self.u2)
         db.session.commit()
 
         # Test if user1 is successfully following user2
-        self.assertTrue(u1.is_following(u2))
+        self.assertTrue(self.u1.is_following(self.u2))
 
         # Test if user2 is NOT following user 1
-        self.assertFalse(u2.is_following(u1))
+        self.assertFalse(self.u2.is_following(self.u1))
 
         # Test is user2 is successfully being followed by user1
-        self.assertTrue(u2.is_followed_by(u1))
+        self.assertTrue(self.u2.is_followed_by(self.u1))
 
         # Test if user1 is NOT being followed by user2
-        self.assertFalse(u1.is_followed_by(u2))
+        self.assertFalse(self.u1.is_followed_by(self.u2))
 
 
     def test_user_signup(self):
         """Test user signup functionality"""
-        u1 = User.query.get(self.u1_id)
+        # The fixture users skip signup's hashing, so sign up a new one
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.commit()
 
         test_user = {
-            "username": 'u1',
-            "email": "u1@email.com",
+            "username": 'u3',
+            "email": "u3@email.com",
             "password": 'password',
             "image_url": "/static/images/default-pic.png"
         }
 
-        #Test is user1 data in database is the same as the data
+        #Test is user3 data in database is the same as the data
         #that was passed in
-        self.assertEqual(u1.username, test_user['username'])
-        self.assertEqual(u1.email, test_user['email'])
-        self.assertNotEqual(u1.password, test_user['password'])
-        self.assertEqual(u1.image_url, test_user['image_url'])
+        self.assertEqual(u3.username, test_user['username'])
+        self.assertEqual(u3.email, test_user['email'])
+        self.assertNotEqual(u3.password, test_user['password'])
+        self.assertEqual(u3.image_url, test_user['image_url'])
 
 
     def test_user_failed_signup_not_unique(self):
@@ -120,15 +105,57 @@ class UserModelTestCase(TestCase):
     def test_user_authentication(self):
         """Test the authentication of user"""
 
-        u1 = User.query.get(self.u1_id)
+        # Authentication works with a valid username/password, and fails
+        # with an invalid username or an invalid password
+        cases = [
+            ("u1", "password", self.u1),
+            ("bad_username", "password", False),
+            ("u1", "bad_password", False),
+        ]
 
-        user = User.authenticate("u1", "password")
+        for username, password, expected in cases:
+            with self.subTest(username=username, password=password):
+                self.assertEqual(
+                    User.authenticate(username, password), expected)
 
-        # Test that authentication works with valid username/password
-        self.assertEqual(u1, user)
 
-        # Test that authentication fails with invalid username
-        self.assertFalse(User.authenticate("bad_username", "password"))
+@pytest.mark.usefixtures("simple_cache")
+class UserAuthCacheTestCase(TestCase):
+    """Tests for caching successful password checks"""
+    def setUp(self):
+        self.u1 = make_user("u1")
+        db.session.add(self.u1)
+        db.session.commit()
+
+    def test_authenticate_with_auth_token(self):
+        """Test that a current auth token skips bcrypt, and a stale or
+        wrong one doesn't"""
+
+        u2 = make_user("u2")
+        db.session.add(u2)
+        db.session.commit()
 
-        # Test that authentication fails with invalid password
-        self.assertFalse(User.authenticate("u1", "bad_password"))
+        with patch.object(
+            bcrypt,
+            "check_password_hash",
+            wraps=bcrypt.check_password_hash,
+        ) as check_password_hash:
+            token = self.u1.issue_auth_token()
+
+            self.assertEqual(
+                User.authenticate("u1", "password", auth_token=token), self.u1)
+            self.assertEqual(check_password_hash.call_count, 0)
+
+            # Only the user it was issued to can use it
+            self.assertFalse(
+                User.authenticate("u2", "bad_password", auth_token=token))
+            self.assertEqual(check_password_hash.call_count, 1)
+
+            # A wrong token is ignored and the password checked
+            self.assertFalse(
+                User.authenticate("u1", "bad_password", auth_token="wrong"))
+            self.assertEqual(check_password_hash.call_count, 2)
+
+            # Issuing a new token retires the old one
+            self.u1.issue_auth_token()
+            self.assertFalse(self.u1.has_auth_token(token))
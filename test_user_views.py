@@ -1,63 +1,102 @@
-"""Message View tests."""
+"""User View tests."""
 
 # run these tests like:
 #
-#    FLASK_DEBUG=False python -m unittest test_message_views.py
+#    python -m pytest test_user_views.py
 
 
-import os
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, Message, User, connect_db
+import pytest
+from sqlalchemy import insert
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
+from models import db, bcrypt, cache, Follows, User
 
-# os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+from testing_helpers import PASSWORD_HASH, count_queries
+from app import app, AUTH_TOKEN_KEY, CURR_USER_KEY
 
-# Now we can import app
+SIGNUP_URL = "/signup"
+LOGIN_URL = "/login"
 
-from app import app, CURR_USER_KEY
+GOOD_SIGNUP = {
+    "username": "test",
+    "email": "test@email.com",
+    "password": "password",
+    "image_url": None,
+}
+BAD_SIGNUP = {
+    "username": "baduser",
+    "email": "bademail",
+    "password": "badpassword",
+    "image_url": None,
+}
+GOOD_LOGIN = {"username": "u1", "password": "password"}
+BAD_LOGIN = {"username": "baduser", "password": "badpassword"}
 
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+PROFILE_NEEDLES = (b"@u1", b"Messages", b"Following", b"Followers")
 
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
 
-connect_db(app)
+class UserBaseViewTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # The users are only made once per class; anything a test changes
+        # is rolled back with its transaction, so they're the same each time
+        super().setUpClass()
+
+        # Insert them all in one statement, and the follow cycle
+        # u1 -> u2 -> u3 -> u1 in another
+        ids = dict(db.session.execute(
+            insert(User)
+            .values([
+                {
+                    "username": username,
+                    "email": f"{username}@email.com",
+                    "password": PASSWORD_HASH,
+                    "followers_count": 1,
+                    "following_count": 1,
+                }
+                for username in ("u1", "u2", "u3")
+            ])
+            .returning(User.username, User.id)
+        ).all())
+
+        db.session.execute(insert(Follows).values([
+            {"user_following_id": ids["u1"], "user_being_followed_id": ids["u2"]},
+            {"user_following_id": ids["u2"], "user_being_followed_id": ids["u3"]},
+            {"user_following_id": ids["u3"], "user_being_followed_id": ids["u1"]},
+        ]))
+        db.session.commit()
 
-db.drop_all()
-db.create_all()
+        cls.u1_id = ids["u1"]
+        cls.u2_id = ids["u2"]
+        cls.u3_id = ids["u3"]
 
-# Don't have WTForms use CSRF at all, since it's a pain to test
+        cls.client = app.test_client()
 
-app.config['WTF_CSRF_ENABLED'] = False
+    @classmethod
+    def tearDownClass(cls):
+        User.query.delete()
+        db.session.commit()
 
+        super().tearDownClass()
 
-class UserBaseViewTestCase(TestCase):
     def setUp(self):
+        # The client is shared by the whole class, so log out whoever the
+        # last test logged in
+        with self.client.session_transaction() as session:
+            session.clear()
 
-        User.query.delete()
-
-        u1 = User.signup("u1", "u1@email.com", "password", None)
-        u2 = User.signup("u2", "u2@email.com", "password", None)
-        u3 = User.signup("u3", "u3@email.com", "password", None)
-        u1.following.append(u2)
-        u2.following.append(u3)
-        u3.following.append(u1)
-        db.session.flush()
+    def assertAllIn(self, needles, html):
+        """Assert that every one of `needles` is in `html`.
 
-        db.session.add(u1, u2)
-        db.session.commit()
+        Checks them all before failing, so the message lists every missing
+        needle rather than just the first.
+        """
 
-        self.u1_id = u1.id
-        self.u2_id = u2.id
-        self.u3_id = u3.id
+        missing = [needle for needle in needles if needle not in html]
+        self.assertFalse(missing, f"Missing from the response: {missing}")
 
-        self.client = app.test_client()
 
 class UserAddViewTestCase(UserBaseViewTestCase):
     """All of the tests for User views/routes"""
@@ -65,169 +104,402 @@ class UserAddViewTestCase(UserBaseViewTestCase):
     def test_add_user_success(self):
         """Test functionality for user registration on success"""
 
-        with app.test_client() as client:
-            url = "/signup"
-            resp = client.post(
-                url, data = {
-                    "username": "test",
-                    "email": "test@email.com",
-                    "password": "password",
-                    "image_url": None},follow_redirects=True)
+        resp = self.client.post(
+            SIGNUP_URL, data=GOOD_SIGNUP, follow_redirects=True)
 
-            html = resp.get_data(as_text=True)
+        html = resp.get_data()
 
-            #Verify that the correct user page appears after user is created
-            self.assertIn("@test", html)
+        #Verify that the correct user page appears after user is created
+        self.assertIn(b"@test", html)
 
-            #Verify that the proper response code is received after user registration
-            self.assertEqual(resp.status_code, 200)
+        #Verify that the proper response code is received after user registration
+        self.assertEqual(resp.status_code, 200)
 
     def test_add_user_failure(self):
         """Test functionality for user registration on failure with bad data"""
 
-        with app.test_client() as client:
-            url = "/signup"
-            resp = client.post(
-                url, data = {
-                    "username": "baduser",
-                    "email": "bademail",
-                    "password": "badpassword",
-                    "image_url": None},follow_redirects=True)
+        resp = self.client.post(SIGNUP_URL, data=BAD_SIGNUP)
 
-            html = resp.get_data(as_text=True)
+        html = resp.get_data()
 
-            self.assertIn("Invalid email", html)
-            # Won't reach the home page where username is displayed with an @
-            self.assertNotIn("@baduser", html)
+        self.assertIn(b"Invalid email", html)
+        # Won't reach the home page where username is displayed with an @
+        self.assertNotIn(b"@baduser", html)
 
-            #Verify that the proper response code is received after user registration
-            self.assertEqual(resp.status_code, 200)
+        #Verify that the proper response code is received after user registration
+        self.assertEqual(resp.status_code, 200)
 
 
     def test_login_user_success(self):
         """Test functionality for user login on success"""
 
-        with app.test_client() as client:
-            url = "/login"
-            resp = client.post(
-                url, data = {
-                    "username": "u1",
-                    "password": "password"
-                }, follow_redirects=True
-            )
+        resp = self.client.post(
+            LOGIN_URL, data=GOOD_LOGIN, follow_redirects=True)
 
-            html = resp.get_data(as_text=True)
+        html = resp.get_data()
 
-            #Verify that the correct user page appears after user is logged in
-            self.assertIn("@u1", html)
+        #Verify that the correct user page appears after user is logged in
+        self.assertIn(b"@u1", html)
 
-            #Verify that the proper response code is received after user login
-            self.assertEqual(resp.status_code, 200)
+        #Verify that the proper response code is received after user login
+        self.assertEqual(resp.status_code, 200)
 
 
     def test_login_user_failure(self):
         """Test functionality for user login on failure with bad data"""
 
-        with app.test_client() as client:
-            url = "/login"
-            resp = client.post(
-                url, data = {
-                    "username": "baduser",
-                    "password": "badpassword"
-                }, follow_redirects=True
-            )
+        resp = self.client.post(LOGIN_URL, data=BAD_LOGIN)
 
-            html = resp.get_data(as_text=True)
+        html = resp.get_data()
 
-            #Verify that the correct user page appears after user is logged in
-            self.assertIn("Invalid credentials", html)
+        #Verify that the correct user page appears after user is logged in
+        self.assertIn(b"Invalid credentials", html)
 
-            #Verify that the proper response code is received after user login
-            self.assertEqual(resp.status_code, 200)
+        #Verify that the proper response code is received after user login
+        self.assertEqual(resp.status_code, 200)
 
 
     def test_view_profile_logged_in(self):
         """Test if user profiles can be visited if logged in"""
 
-        with app.test_client() as client:
-
-            with client.session_transaction() as session:
-                session[CURR_USER_KEY] = self.u1_id
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.u1_id
 
-            url = f"/users/{self.u1_id}"
-            resp = client.get(url, follow_redirects=True)
+        url = f"/users/{self.u1_id}"
+        resp = self.client.get(url)
 
-            html = resp.get_data(as_text=True)
+        html = resp.get_data()
 
-            self.assertIn("@u1", html)
-            self.assertIn("Messages", html)
-            self.assertIn("Following", html)
-            self.assertIn("Followers", html)
-            self.assertEqual(resp.status_code, 200)
+        self.assertAllIn(PROFILE_NEEDLES, html)
+        self.assertEqual(resp.status_code, 200)
 
 
     def test_view_profile_logged_out(self):
         """Test if user profiles can be visited if logged out"""
 
-        with app.test_client() as client:
+        url = f"/users/{self.u1_id}"
+        resp = self.client.get(url)
 
-            url = f"/users/{self.u1_id}"
-            resp = client.get(url, follow_redirects=True)
-
-            self.assertEqual(resp.status_code, 401)
+        self.assertEqual(resp.status_code, 401)
 
 
     def test_view_followers_logged_in(self):
         """Test if followers can be viewed if logged in"""
 
-        with app.test_client() as client:
-
-            with client.session_transaction() as session:
-                session[CURR_USER_KEY] = self.u1_id
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.u1_id
 
-            url = f"/users/{self.u1_id}/followers"
-            resp = client.get(url, follow_redirects=True)
+        url = f"/users/{self.u1_id}/followers"
+        resp = self.client.get(url)
 
-            html = resp.get_data(as_text=True)
+        html = resp.get_data()
 
-            self.assertIn("@u3", html)
-            self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"@u3", html)
+        self.assertEqual(resp.status_code, 200)
 
 
     def test_view_followers_logged_out(self):
         """Test if followers can be viewed if logged out"""
 
-        with app.test_client() as client:
-
-            url = f"/users/{self.u1_id}/followers"
-            resp = client.get(url, follow_redirects=True)
+        url = f"/users/{self.u1_id}/followers"
+        resp = self.client.get(url)
 
-            self.assertEqual(resp.status_code, 401)
+        self.assertEqual(resp.status_code, 401)
 
 
     def test_view_following_logged_in(self):
         """Test if following can be viewed if logged in"""
 
-        with app.test_client() as client:
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.u1_id
 
-            with client.session_transaction() as session:
-                session[CURR_USER_KEY] = self.u1_id
+        url = f"/users/{self.u1_id}/following"
+        resp = self.client.get(url)
 
-            url = f"/users/{self.u1_id}/following"
-            resp = client.get(url, follow_redirects=True)
+        html = resp.get_data()
 
-            html = resp.get_data(as_text=True)
-
-            self.assertIn("@u2", html)
-            self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"@u2", html)
+        self.assertEqual(resp.status_code, 200)
 
 
     def test_view_following_logged_out(self):
         """Test if following can be viewed if logged out"""
 
-        with app.test_client() as client:
+        url = f"/users/{self.u1_id}/following"
+        resp = self.client.get(url)
+
+        self.assertEqual(resp.status_code, 401)
+
+
+    def test_follow_updates_counts(self):
+        """Test if following and unfollowing keep the follow counts in step"""
+
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.u1_id
+
+        u1 = db.session.get(User, self.u1_id)
+        u3 = db.session.get(User, self.u3_id)
+        following_count = u1.following_count
+        followers_count = u3.followers_count
+
+        self.client.post(f"/users/follow/{self.u3_id}")
+
+        self.assertEqual(u1.following_count, following_count + 1)
+        self.assertEqual(u3.followers_count, followers_count + 1)
+        self.assertTrue(u1.is_following(u3))
+
+        # Following someone twice is still just one follow
+        resp = self.client.post(f"/users/follow/{self.u3_id}")
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(u1.following_count, following_count + 1)
+
+        self.client.post(f"/users/stop-following/{self.u3_id}")
+
+        self.assertEqual(u1.following_count, following_count)
+        self.assertEqual(u3.followers_count, followers_count)
+        self.assertFalse(u1.is_following(u3))
+
+
+    def test_homepage_cache_headers(self):
+        """Test if only the logged out homepage can be cached"""
+
+        resp = self.client.get("/")
+
+        self.assertTrue(resp.cache_control.public)
+        self.assertFalse(resp.cache_control.no_store)
+
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.u1_id
+
+        resp = self.client.get("/")
+
+        self.assertFalse(resp.cache_control.public)
+        self.assertTrue(resp.cache_control.no_store)
+
+
+    def test_search_users(self):
+        """Test if searching for users ignores case and keeps the first
+        results by username"""
+
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.u1_id
+
+        resp = self.client.get("/users", query_string={"q": "U1"})
+        html = resp.get_data()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"@u1", html)
+        self.assertNotIn(b"@u2", html)
+
+        with patch("app.SEARCH_RESULTS_LIMIT", 2):
+            html = self.client.get("/users", query_string={"q": "u"}).get_data()
+
+        self.assertEqual(html.count(b'class="card-link"'), 2)
+        self.assertLess(html.index(b"@u1"), html.index(b"@u2"))
+        self.assertNotIn(b"@u3", html)
+
+
+@pytest.mark.usefixtures("simple_cache")
+class UserCacheViewTestCase(UserBaseViewTestCase):
+    """Tests for the cached logged-in user, and the routes that clear it"""
+
+    def login(self, user_id):
+        """Log the client in as this user, and load them into the cache."""
+
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = user_id
+
+        self.client.get("/")
+
+    def cached_user(self, user_id):
+        return cache.get(f"user:{user_id}")
+
+    def add_users(self, count):
+        """Sign up `count` more users; returns their ids."""
+
+        return db.session.scalars(
+            insert(User)
+            .values([
+                {
+                    "username": f"extra{i}",
+                    "email": f"extra{i}@email.com",
+                    "password": PASSWORD_HASH,
+                }
+                for i in range(count)
+            ])
+            .returning(User.id)
+        ).all()
+
+    def add_follows(self, follows):
+        """Add follows from (follower id, followed id) pairs."""
+
+        db.session.execute(insert(Follows).values([
+            {"user_following_id": follower_id, "user_being_followed_id": id}
+            for follower_id, id in follows
+        ]))
+        db.session.commit()
+
+    def test_cached_user_is_used(self):
+        """Test if a cached user is used instead of loading them again"""
+
+        self.login(self.u1_id)
+
+        self.assertEqual(self.cached_user(self.u1_id)["username"], "u1")
+
+        # Their own profile page needs nothing from the DB but their messages
+        with patch.object(db.session, "get", wraps=db.session.get) as get:
+            resp = self.client.get(f"/users/{self.u1_id}")
+
+        get.assert_not_called()
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"@u1", resp.get_data())
+
+    def test_profile_edit_clears_cached_user(self):
+        """Test if the next request sees an edited profile"""
+
+        self.login(self.u1_id)
+
+        resp = self.client.post("/users/profile", data={
+            "username": "u1",
+            "email": "u1@email.com",
+            "bio": "Edited bio",
+            "password": "password",
+        })
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertIsNone(self.cached_user(self.u1_id))
+
+        resp = self.client.get(f"/users/{self.u1_id}")
+
+        self.assertIn(b"Edited bio", resp.get_data())
+        self.assertEqual(self.cached_user(self.u1_id)["bio"], "Edited bio")
+
+    def test_login_token_spares_profile_password_check(self):
+        """Test if editing the profile just after logging in skips bcrypt,
+        and logging out retires the token"""
+
+        self.client.post(LOGIN_URL, data=GOOD_LOGIN)
+
+        with patch.object(
+            bcrypt,
+            "check_password_hash",
+            wraps=bcrypt.check_password_hash,
+        ) as check_password_hash:
+            resp = self.client.post("/users/profile", data={
+                "username": "u1",
+                "email": "u1@email.com",
+                "password": "password",
+            })
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(check_password_hash.call_count, 0)
+
+        self.client.post("/logout")
+
+        with self.client.session_transaction() as session:
+            self.assertNotIn(AUTH_TOKEN_KEY, session)
+        self.assertIsNone(cache.get(f"auth:{self.u1_id}"))
+
+    def test_follow_clears_cached_counts(self):
+        """Test if the next request sees the counts a follow changed"""
+
+        self.login(self.u3_id)
+        self.login(self.u1_id)
+
+        self.client.post(f"/users/follow/{self.u3_id}")
+
+        self.assertIsNone(self.cached_user(self.u1_id))
+        self.assertIsNone(self.cached_user(self.u3_id))
+
+        self.login(self.u3_id)
+        self.assertEqual(self.cached_user(self.u3_id)["followers_count"], 2)
+        self.login(self.u1_id)
+        self.assertEqual(self.cached_user(self.u1_id)["following_count"], 2)
+
+        self.client.post(f"/users/stop-following/{self.u3_id}")
+
+        self.assertIsNone(self.cached_user(self.u1_id))
+        self.assertIsNone(self.cached_user(self.u3_id))
+
+        self.login(self.u3_id)
+        self.assertEqual(self.cached_user(self.u3_id)["followers_count"], 1)
+        self.login(self.u1_id)
+        self.assertEqual(self.cached_user(self.u1_id)["following_count"], 1)
+
+    def test_delete_user_clears_cached_follows(self):
+        """Test if deleting a user clears everyone whose counts it changed"""
+
+        self.login(self.u2_id)
+        self.login(self.u3_id)
+        self.login(self.u1_id)
+
+        self.client.post("/users/delete")
+
+        for user_id in (self.u1_id, self.u2_id, self.u3_id):
+            self.assertIsNone(self.cached_user(user_id))
+
+        # u1 was following u2, and followed by u3
+        self.login(self.u2_id)
+        self.assertEqual(self.cached_user(self.u2_id)["followers_count"], 0)
+        self.login(self.u3_id)
+        self.assertEqual(self.cached_user(self.u3_id)["following_count"], 0)
+
+    def test_search_caches_user_ids(self):
+        """Test if a search's results are cached, and the cached ids used"""
+
+        self.login(self.u1_id)
+
+        self.client.get("/users", query_string={"q": "U1"})
+
+        self.assertEqual(cache.get("user-search:U1"), [self.u1_id])
+
+        # Swap the cached ids, to see the next search shows those users,
+        # still in username order
+        cache.set("user-search:U1", [self.u3_id, self.u2_id])
+        html = self.client.get("/users", query_string={"q": "U1"}).get_data()
+
+        self.assertLess(html.index(b"@u2"), html.index(b"@u3"))
+        self.assertNotIn(b"@u1", html)
+
+    def test_user_list_queries_with_cached_user(self):
+        """Test if the follow buttons on the user list cost one query in all,
+        however many users are listed"""
+
+        self.add_follows((self.u1_id, id) for id in self.add_users(10))
+        self.login(self.u1_id)
+
+        with count_queries() as queries:
+            resp = self.client.get("/users")
+
+        self.assertEqual(resp.get_data().count(b"Unfollow"), 11)
+        self.assertLessEqual(len(queries), 2)
+
+    def test_following_page_queries_with_cached_user(self):
+        """Test if the following page's queries don't grow with the number
+        of users followed"""
+
+        self.add_follows((self.u1_id, id) for id in self.add_users(10))
+        self.login(self.u1_id)
+
+        with count_queries() as queries:
+            resp = self.client.get(f"/users/{self.u1_id}/following")
+
+        self.assertEqual(resp.get_data().count(b"Unfollow"), 11)
+        self.assertLessEqual(len(queries), 2)
+
+    def test_followers_page_queries_with_cached_user(self):
+        """Test if the followers page's queries don't grow with the number
+        of followers"""
+
+        # Ten new followers, half of whom u1 follows back
+        extra_ids = self.add_users(10)
+        self.add_follows((id, self.u1_id) for id in extra_ids)
+        self.add_follows((self.u1_id, id) for id in extra_ids[:5])
+        self.login(self.u1_id)
 
-            url = f"/users/{self.u1_id}/following"
-            resp = client.get(url, follow_redirects=True)
+        with count_queries() as queries:
+            resp = self.client.get(f"/users/{self.u1_id}/followers")
 
-            self.assertEqual(resp.status_code, 401)
+        self.assertEqual(resp.get_data().count(b"Unfollow"), 5)
+        self.assertLessEqual(len(queries), 3)
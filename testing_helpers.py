@@ -0,0 +1,47 @@
+"""Helpers shared by the test modules."""
+
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from models import db, bcrypt, User, DEFAULT_IMAGE_URL
+
+# Every fixture user has the password "password", so hash it once rather than
+# once per User.signup; test_user_signup still signs up for real. (conftest.py
+# has set the app up, with its low test cost factor, by the time this runs.)
+
+PASSWORD_HASH = bcrypt.generate_password_hash("password").decode('UTF-8')
+
+
+def make_user(username):
+    """Make a user called `username` with the password "password"."""
+
+    return User(
+        username=username,
+        email=f"{username}@email.com",
+        password=PASSWORD_HASH,
+        image_url=DEFAULT_IMAGE_URL,
+    )
+
+
+@contextmanager
+def count_queries():
+    """Collect every SQL statement run inside the block into a list.
+
+    Used to put a ceiling on the queries a route makes, so an accidental
+    lazy load (an N+1) fails the test instead of slipping through. The
+    SAVEPOINTs the test transaction wraps around each commit aren't counted,
+    since the app doesn't run them outside the tests.
+    """
+
+    queries = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        if "SAVEPOINT" not in statement:
+            queries.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield queries
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)